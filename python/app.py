@@ -1,21 +1,27 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import time
-from typing import Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import re
 from datetime import datetime
 import subprocess
+import signal
 import tempfile
 import os
 import sys
+import threading
+import multiprocessing
+import queue
+from contextlib import contextmanager
 import zipfile
 import git
 from pathlib import Path
+from functools import lru_cache
+from collections import deque
 import hashlib
-from sentence_transformers import SentenceTransformer
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 import pickle
 import shutil
 import PyPDF2
@@ -23,14 +29,50 @@ import docx
 from docx import Document
 import io
 import sqlite3
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import tiktoken
+import zstandard as zstd
 import pptx
 from pptx import Presentation
 import openpyxl
 from openpyxl import load_workbook
 import csv
 import xml.etree.ElementTree as ET
+from pdf_worker import extract_pdf_pages
+
+# ONNX Runtime backend for embeddings (preferred)
+try:
+    import onnxruntime as ort
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    from transformers import AutoTokenizer
+    from huggingface_hub import hf_hub_download
+except ImportError:
+    ort = None
+
+# PyTorch backend for embeddings (preferred on CUDA GPUs, otherwise the fallback).
+# Optional: install with `pip install -r requirements-gpu.txt`
+try:
+    import torch
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    torch = None
+    SentenceTransformer = None
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """tiktoken encoding for a model, using cl100k_base for models tiktoken does not know."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        try:
+            return tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            return None
+    except Exception:
+        return None
+
+# Shared tokenizer, loaded once at import instead of on every count
+_ENCODING = get_encoding("gpt-3.5-turbo")
 
 # Page configuration
 st.set_page_config(
@@ -149,8 +191,6 @@ if 'max_tokens' not in st.session_state:
     st.session_state.max_tokens = 4000
 if 'codebase_data' not in st.session_state:
     st.session_state.codebase_data = {}
-if 'embeddings_model' not in st.session_state:
-    st.session_state.embeddings_model = None
 if 'code_embeddings' not in st.session_state:
     st.session_state.code_embeddings = {}
 if 'codebase_handler' not in st.session_state:
@@ -205,6 +245,12 @@ ALL_EXTENSIONS = {
     '.zip', '.tar', '.gz', '.rar', '.7z'
 }
 
+# File uploader type filter, built once rather than on every rerun
+UPLOADER_TYPES = tuple(sorted(ext.lstrip('.') for ext in ALL_EXTENSIONS))
+
+# Directories never descended into when processing a directory
+SKIP_DIRS = frozenset({'.git', '__pycache__', 'node_modules', '.venv', 'venv', '.vs', '.vscode'})
+
 # Groq models with context windows
 GROQ_MODELS = {
     "llama-3.1-8b-instant": {"name": "Llama 3.1 8B (Fastest)", "context": 128000},
@@ -234,35 +280,218 @@ FILE_PRIORITY = {
     '.png': 1, '.jpg': 1, '.jpeg': 1, '.gif': 1, '.bmp': 1
 }
 
+# Language-specific patterns for semantic chunk boundaries
+BOUNDARY_PATTERNS = {
+    ext: [re.compile(pattern) for pattern in patterns]
+    for ext, patterns in {
+        '.py': [r'^\s*(def |class |import |from )', r'^\s*#.*', r'^\s*""".*"""'],
+        '.js': [r'^\s*(function |class |const |let |var )', r'^\s*/\*.*\*/', r'^\s*//.*'],
+        '.java': [r'^\s*(public |private |protected |class |interface )', r'^\s*/\*.*\*/', r'^\s*//.*'],
+        '.cpp': [r'^\s*(class |struct |namespace |#include)', r'^\s*/\*.*\*/', r'^\s*//.*'],
+        '.go': [r'^\s*(func |type |package |import)', r'^\s*/\*.*\*/', r'^\s*//.*'],
+        '.md': [r'^#+ ', r'^-{3,}', r'^={3,}'],
+        '.txt': [r'^[A-Z][^a-z]*$', r'^\d+\.', r'^-'],
+    }.items()
+}
+DEFAULT_BOUNDARY_PATTERNS = [re.compile(r'^\s*$')]
+
+# Keywords used to classify chunks
+WORD_PATTERN = re.compile(r'\w+')
+CLASS_KEYWORDS = frozenset(['class', 'function', 'def'])
+IMPORT_KEYWORDS = frozenset(['import', 'include', 'require'])
+
+# Fenced code blocks in chat messages: language tag on the opening line, then the body
+CODE_BLOCK_PATTERN = re.compile(r'```([^\n`]*)\n(.*?)```', re.DOTALL)
+
+def _iter_line_spans(text: str):
+    """Yield (start, end) offsets of each newline-separated line without splitting the text."""
+    start = 0
+    length = len(text)
+    while start <= length:
+        end = text.find('\n', start)
+        if end == -1:
+            end = length
+        yield start, end
+        start = end + 1
+
+def _read_text_lines(file_path: str):
+    """Yield decoded lines of a text file while streaming its raw bytes."""
+    with open(file_path, 'rb') as f:
+        yield from _decode_lines(f)
+
+def _decode_lines(raw_lines):
+    """Decode an iterable of raw byte lines, as produced by a binary file object."""
+    ends_with_newline = True
+    for raw_line in raw_lines:
+        ends_with_newline = raw_line.endswith(b'\n')
+        yield raw_line.decode('utf-8', errors='ignore').rstrip('\r\n')
+    if ends_with_newline:
+        # Match str.split('\n'), which yields a trailing empty line
+        yield ''
+
+def _hash_file(file_path: str) -> str:
+    """Hash raw file bytes with BLAKE2b without decoding the content."""
+    with open(file_path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+        digest = hashlib.blake2b(digest_size=16)
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+        return digest.hexdigest()
+
+# Extensions that need a document parser rather than plain text decoding
+PARSED_EXTENSIONS = {'.pdf', '.docx', '.doc', '.pptx', '.ppt', '.xlsx', '.xls', '.csv'}
+
+# Cache database schema version; the cache is rebuilt when this changes
+SCHEMA_VERSION = 7
+
+# Embedding storage and search settings
+EMBEDDING_DIM = 384
+# Rows are stored as int8 with a per-row scale (row * scale recovers the unit vector)
+EMBEDDING_DTYPE = np.int8
+
+# Pages per PDF extraction task sent to the process pool
+PDF_PAGES_PER_TASK = 16
+
+@st.cache_resource
+def get_pdf_pool() -> ProcessPoolExecutor:
+    """Shared process pool for CPU-bound PDF parsing.
+    
+    Workers are started from a forkserver (or spawned) rather than forked from the
+    multi-threaded Streamlit server, which could copy locks held by other threads.
+    """
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, 6),
+                               mp_context=multiprocessing.get_context(method))
+
 class EnhancedCodebaseHandler:
     """Enhanced handler for large codebases with support for all file types."""
     
     def __init__(self, db_path: str = None):
         self.db_path = db_path or os.path.join(tempfile.gettempdir(), "enhanced_codebase_cache.db")
+        self.matrix_path = os.path.splitext(self.db_path)[0] + "_embeddings.i8"
         self.embeddings_model = None
         self.encoding = None
+        self._chunk_matrix = None
+        self._chunk_ids = []
+        self._chunk_rows = {}
+        self._row_scales = np.zeros(0, dtype=np.float32)
+        self._matrix_dirty = True
+        self._matrix_version = None
+        self._lock = threading.RLock()
+        self._compressor = zstd.ZstdCompressor(level=3)
+        # Decompression also runs on process_files worker threads, and a ZstdDecompressor
+        # must not be shared between threads, so each thread gets its own
+        self._thread_local = threading.local()
+        self.conn = self._connect()
         self.init_database()
         self.init_tokenizer()
         
+        # Retrieval caches, keyed by the corpus version stored in the database
+        self._relevant_files_cache = lru_cache(maxsize=128)(self._get_relevant_files)
+        self._relevant_chunks_cache = lru_cache(maxsize=128)(self._get_relevant_chunks)
+        self._recent_queries = deque(maxlen=32)
+        
     def init_tokenizer(self):
         """Initialize tokenizer for accurate token counting."""
-        try:
-            self.encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        except:
-            self.encoding = None
-    
-    def count_tokens(self, text: str) -> int:
-        """Count tokens accurately."""
-        if self.encoding:
-            return len(self.encoding.encode(str(text)))
-        else:
-            return len(str(text)) // 4
+        self.encoding = _ENCODING
+    
+    def _compress(self, text: str) -> bytes:
+        """Compress chunk text for storage."""
+        return self._compressor.compress(text.encode('utf-8'))
+    
+    def _decompress(self, data: bytes) -> str:
+        """Decompress stored chunk text."""
+        decompressor = getattr(self._thread_local, 'decompressor', None)
+        if decompressor is None:
+            decompressor = self._thread_local.decompressor = zstd.ZstdDecompressor()
+        return decompressor.decompress(data).decode('utf-8')
+    
+    @staticmethod
+    def _fast_estimate(text: str) -> int:
+        """Cheap token estimate used for chunk boundary decisions."""
+        return (len(text) + 3) // 4
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Open the shared database connection with performance pragmas applied."""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-64000")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+    
+    def close(self):
+        """Close the shared database connection."""
+        with self._lock:
+            self._chunk_matrix = None
+            self.conn.close()
+    
+    def clear_storage(self):
+        """Remove every stored file and embedding in place.
+        
+        Other sessions keep their connections to the same database, so the files are emptied
+        rather than deleted; the bumped corpus version makes their handlers reload.
+        """
+        with self._transaction(immediate=True) as cursor:
+            cursor.execute("DELETE FROM embeddings")
+            cursor.execute("DELETE FROM file_chunks")
+            cursor.execute("DELETE FROM files")
+            cursor.execute("UPDATE meta SET value = value + 1 WHERE key = 'corpus_version'")
+            
+            # Swap in an empty matrix file instead of truncating it, so memory maps held by
+            # other handlers keep pointing at the old, still-valid file until they reload
+            partial_path = f"{self.matrix_path}.{os.getpid()}.partial"
+            open(partial_path, 'wb').close()
+            os.replace(partial_path, self.matrix_path)
+        
+        self._chunk_matrix = None
+        self._matrix_dirty = True
+    
+    @contextmanager
+    def _transaction(self, immediate: bool = False):
+        """Hold the handler lock and run the enclosed statements in one transaction.
+        
+        With immediate=True the database write lock is taken up front, serializing the
+        block against other connections to the same database file.
+        """
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield cursor
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+    
+    def _corpus_version(self) -> int:
+        """Current corpus version, shared by every handler on this database."""
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT value FROM meta WHERE key = 'corpus_version'")
+            return cursor.fetchone()[0]
     
     def init_database(self):
         """Initialize SQLite database for codebase storage."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self._transaction() as cursor:
+            cursor.execute("PRAGMA user_version")
+            if cursor.fetchone()[0] != SCHEMA_VERSION:
+                # The database is a disposable cache, so rebuild it when the schema changes
+                for table in ('files_fts', 'embeddings', 'file_chunks', 'files', 'meta'):
+                    cursor.execute(f"DROP TABLE IF EXISTS {table}")
+                if os.path.exists(self.matrix_path):
+                    os.remove(self.matrix_path)
+            self._create_schema(cursor)
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            
+            # Forget embeddings whose rows are missing from the matrix file
+            cursor.execute("DELETE FROM embeddings WHERE row_index >= ?", (self._matrix_row_count(),))
+    
+    def _create_schema(self, cursor):
+        """Create tables and indexes if they do not exist."""
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS files (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -286,34 +515,63 @@ class EnhancedCodebaseHandler:
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 file_id INTEGER,
                 chunk_index INTEGER,
-                content TEXT,
+                content BLOB,
                 tokens INTEGER,
                 start_line INTEGER,
                 end_line INTEGER,
                 chunk_type TEXT DEFAULT 'general',
                 chunk_hash TEXT,
                 relevance_score REAL DEFAULT 0.0,
-                FOREIGN KEY (file_id) REFERENCES files (id)
+                FOREIGN KEY (file_id) REFERENCES files (id) ON DELETE CASCADE
             )
         """)
         
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS embeddings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chunk_id INTEGER,
-                embedding BLOB,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (chunk_id) REFERENCES file_chunks (id)
+                chunk_id INTEGER PRIMARY KEY,
+                row_index INTEGER,
+                scale REAL,
+                FOREIGN KEY (chunk_id) REFERENCES file_chunks (id) ON DELETE CASCADE
+            )
+        """)
+        
+        # Full-text index over file metadata, kept in sync with the files table by triggers
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+                file_path, content_preview, extension, content='files', content_rowid='id'
             )
         """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS files_fts_insert AFTER INSERT ON files BEGIN
+                INSERT INTO files_fts (rowid, file_path, content_preview, extension)
+                VALUES (new.id, new.file_path, new.content_preview, new.extension);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS files_fts_delete AFTER DELETE ON files BEGIN
+                INSERT INTO files_fts (files_fts, rowid, file_path, content_preview, extension)
+                VALUES ('delete', old.id, old.file_path, old.content_preview, old.extension);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS files_fts_update AFTER UPDATE ON files BEGIN
+                INSERT INTO files_fts (files_fts, rowid, file_path, content_preview, extension)
+                VALUES ('delete', old.id, old.file_path, old.content_preview, old.extension);
+                INSERT INTO files_fts (rowid, file_path, content_preview, extension)
+                VALUES (new.id, new.file_path, new.content_preview, new.extension);
+            END
+        """)
         
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_path ON files(file_path)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_priority ON files(priority DESC, tokens ASC)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_chunk_tokens ON file_chunks(tokens)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_chunk_relevance ON file_chunks(relevance_score DESC)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_hash ON files(file_hash)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_chunk_hash ON file_chunks(chunk_hash)")
         
-        conn.commit()
-        conn.close()
+        # Corpus version shared by every handler on this database, bumped whenever a file is stored
+        cursor.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+        cursor.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('corpus_version', 0)")
     
     def extract_text_from_file(self, file_path: str) -> str:
         """Extract text from various file formats with enhanced error handling."""
@@ -365,12 +623,18 @@ class EnhancedCodebaseHandler:
     def extract_pdf_text(self, file_path: str) -> str:
         """Extract text from PDF files with error handling."""
         try:
-            text = ""
             with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                for page in pdf_reader.pages:
-                    text += page.extract_text() + "\n"
-            return text
+                page_count = len(PyPDF2.PdfReader(file).pages)
+            
+            # Split the document into page ranges and parse them in separate processes
+            try:
+                pool = get_pdf_pool()
+                futures = [pool.submit(extract_pdf_pages, file_path, start, start + PDF_PAGES_PER_TASK)
+                           for start in range(0, page_count, PDF_PAGES_PER_TASK)]
+                return "".join(future.result() for future in futures)
+            except Exception:
+                # Fall back to in-process parsing if the pool is unavailable
+                return extract_pdf_pages(file_path, 0, page_count)
         except Exception as e:
             return f"[PDF Error: {str(e)}]"
     
@@ -411,127 +675,215 @@ class EnhancedCodebaseHandler:
         """Extract text from Excel files with error handling."""
         try:
             workbook = load_workbook(file_path, read_only=True)
-            text = []
-            
-            for sheet_name in workbook.sheetnames:
-                sheet = workbook[sheet_name]
-                text.append(f"Sheet: {sheet_name}")
+            try:
+                # Stream rows straight into one buffer instead of a list of row strings
+                buf = io.StringIO()
+                for sheet_name in workbook.sheetnames:
+                    if buf.tell():
+                        buf.write("\n")
+                    buf.write(f"Sheet: {sheet_name}")
+                    
+                    for row in workbook[sheet_name].iter_rows(values_only=True):
+                        buf.write("\n")
+                        buf.write("\t".join(
+                            "" if cell is None else cell if type(cell) is str else str(cell)
+                            for cell in row
+                        ))
                 
-                for row in sheet.iter_rows(values_only=True):
-                    row_text = [str(cell) if cell is not None else "" for cell in row]
-                    text.append("\t".join(row_text))
-            
-            return "\n".join(text)
+                return buf.getvalue()
+            finally:
+                workbook.close()
         except Exception as e:
             return f"[Excel Error: {str(e)}]"
     
     def extract_csv_text(self, file_path: str) -> str:
         """Extract text from CSV files with error handling."""
         try:
-            text = []
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
-                csv_reader = csv.reader(file)
-                for row in csv_reader:
-                    text.append("\t".join(row))
-            return "\n".join(text)
+            with open(file_path, 'r', encoding='utf-8', errors='ignore', newline='', buffering=1 << 20) as file:
+                return "\n".join("\t".join(row) for row in csv.reader(file))
         except Exception as e:
             return f"[CSV Error: {str(e)}]"
     
     def smart_chunk_content(self, content: str, file_ext: str, max_tokens: int = 2000) -> List[Dict]:
         """Smart chunking that respects file structure and semantic boundaries."""
-        lines = content.split('\n')
+        lines = (content[start:end] for start, end in _iter_line_spans(content))
+        return self._chunk_lines(lines, file_ext, max_tokens, text=content)
+    
+    def _chunk_lines(self, lines, file_ext: str, max_tokens: int = 2000, text: Optional[str] = None) -> List[Dict]:
+        """Chunk an iterable of lines in a single pass.
+        
+        When ``text`` is the string the lines were cut from, chunks are sliced from it by
+        offset; otherwise only the current chunk's lines are buffered.
+        """
         chunks = []
-        current_chunk = []
+        current_chunk = []  # Lines of the current chunk, buffered only when text is None
+        chunk_lines = 0
+        chunk_start = 0  # Offset of the current chunk's first character in text
+        chunk_end = 0  # Offset just past the current chunk's last line in text
+        position = 0
         current_tokens = 0
         start_line = 0
         chunk_type = 'general'
         
-        # Language-specific patterns for semantic boundaries
-        boundary_patterns = {
-            '.py': [r'^\s*(def |class |import |from )', r'^\s*#.*', r'^\s*""".*"""'],
-            '.js': [r'^\s*(function |class |const |let |var )', r'^\s*/\*.*\*/', r'^\s*//.*'],
-            '.java': [r'^\s*(public |private |protected |class |interface )', r'^\s*/\*.*\*/', r'^\s*//.*'],
-            '.cpp': [r'^\s*(class |struct |namespace |#include)', r'^\s*/\*.*\*/', r'^\s*//.*'],
-            '.go': [r'^\s*(func |type |package |import)', r'^\s*/\*.*\*/', r'^\s*//.*'],
-            '.md': [r'^#+ ', r'^-{3,}', r'^={3,}'],
-            '.txt': [r'^[A-Z][^a-z]*$', r'^\d+\.', r'^-'],
-        }
-        
-        patterns = boundary_patterns.get(file_ext, [r'^\s*$'])
+        patterns = BOUNDARY_PATTERNS.get(file_ext, DEFAULT_BOUNDARY_PATTERNS)
+        is_text_file = file_ext in ['.md', '.txt']
         
         for i, line in enumerate(lines):
-            line_tokens = self.count_tokens(line)
+            line_start = position
+            position += len(line) + 1
+            line_tokens = self._fast_estimate(line)
             
             # Check for semantic boundaries
-            is_boundary = any(re.match(pattern, line) for pattern in patterns)
+            is_boundary = any(pattern.match(line) for pattern in patterns)
             
-            # Determine chunk type
-            if any(keyword in line.lower() for keyword in ['class', 'function', 'def']):
-                chunk_type = 'class_function'
-            elif any(keyword in line.lower() for keyword in ['import', 'include', 'require']):
-                chunk_type = 'imports'
-            elif line.strip().startswith(('#', '//', '/*')):
-                chunk_type = 'comments'
-            elif file_ext in ['.md', '.txt']:
-                if line.startswith('#'):
-                    chunk_type = 'heading'
-                elif line.strip() == '':
-                    chunk_type = 'paragraph_break'
+            # Determine chunk type (only boundary lines can change it)
+            if is_boundary:
+                words = set(WORD_PATTERN.findall(line.lower()))
+                if CLASS_KEYWORDS & words:
+                    chunk_type = 'class_function'
+                elif IMPORT_KEYWORDS & words:
+                    chunk_type = 'imports'
+                elif line.lstrip().startswith(('#', '//', '/*')):
+                    chunk_type = 'comments'
+                elif is_text_file:
+                    if line.startswith('#'):
+                        chunk_type = 'heading'
+                    elif not line.strip():
+                        chunk_type = 'paragraph_break'
             
             # Start new chunk at boundaries or when size limit reached
             if ((is_boundary and current_tokens > max_tokens * 0.5) or 
-                (current_tokens + line_tokens > max_tokens)) and current_chunk:
+                (current_tokens + line_tokens > max_tokens)) and chunk_lines:
                 
-                chunk_content = '\n'.join(current_chunk)
                 chunks.append({
-                    'content': chunk_content,
+                    'content': text[chunk_start:chunk_end] if text is not None else '\n'.join(current_chunk),
                     'tokens': current_tokens,
                     'start_line': start_line,
-                    'end_line': start_line + len(current_chunk) - 1,
+                    'end_line': start_line + chunk_lines - 1,
                     'chunk_type': chunk_type
                 })
                 
-                current_chunk = [line]
-                current_tokens = line_tokens
+                current_chunk = []
+                chunk_start = line_start
+                chunk_lines = 0
+                current_tokens = 0
                 start_line = i
-            else:
+            
+            if text is None:
                 current_chunk.append(line)
-                current_tokens += line_tokens
+            chunk_end = line_start + len(line)
+            chunk_lines += 1
+            current_tokens += line_tokens
         
         # Add final chunk
-        if current_chunk:
-            chunk_content = '\n'.join(current_chunk)
+        if chunk_lines:
             chunks.append({
-                'content': chunk_content,
+                'content': text[chunk_start:chunk_end] if text is not None else '\n'.join(current_chunk),
                 'tokens': current_tokens,
                 'start_line': start_line,
-                'end_line': start_line + len(current_chunk) - 1,
+                'end_line': start_line + chunk_lines - 1,
                 'chunk_type': chunk_type
             })
         
+        # Replace boundary estimates with exact counts, one tokenizer call per file
+        if self.encoding and chunks:
+            encoded = self.encoding.encode_batch([chunk['content'] for chunk in chunks], disallowed_special=())
+            for chunk, tokens in zip(chunks, encoded):
+                chunk['tokens'] = len(tokens)
+        
         return chunks
     
-    def process_file(self, file_path: str) -> bool:
-        """Process a single file with enhanced error handling."""
+    def _prepare_file(self, file_path: str, max_file_size: int, data: Optional[bytes] = None,
+                      claim=None) -> Dict:
+        """Extract and chunk a file without touching Streamlit state or the database.
+        
+        When ``data`` is given it is used as the file's content and ``file_path`` is only its name.
+        ``claim((file_hash, extension))`` is called before extraction; if it returns False the
+        content is already being extracted for another file and ``{'duplicate': True}`` is returned.
+        """
         try:
             # Check file size
-            file_size = os.path.getsize(file_path)
-            if file_size > st.session_state.max_file_size:
-                st.warning(f"Skipping large file: {os.path.basename(file_path)} ({file_size / 1024 / 1024:.1f}MB)")
-                return False
+            file_size = os.path.getsize(file_path) if data is None else len(data)
+            if file_size > max_file_size:
+                return {'warning': f"Skipping large file: {os.path.basename(file_path)} ({file_size / 1024 / 1024:.1f}MB)"}
+            
+            # Skip extraction entirely if the file is unchanged since it was last processed
+            if data is None:
+                file_hash = _hash_file(file_path)
+            else:
+                file_hash = hashlib.blake2b(data, digest_size=16).hexdigest()
+            extension = Path(file_path).suffix.lower()
+            with self._lock:
+                cursor = self.conn.cursor()
+                cursor.execute("SELECT id FROM files WHERE file_path = ? AND file_hash = ? AND is_processed = TRUE",
+                               (file_path, file_hash))
+                if cursor.fetchone():
+                    return {'unchanged': True}
+            if claim is not None and not claim((file_hash, extension)):
+                return {'duplicate': True}
+            with self._lock:
+                cursor = self.conn.cursor()
+                
+                # Identical content stored under another path: copy its chunks instead of re-extracting
+                cursor.execute("""
+                    SELECT id, file_type, lines, tokens, priority, content_preview FROM files
+                    WHERE file_hash = ? AND extension = ? AND file_path != ? AND is_processed = TRUE
+                    LIMIT 1
+                """, (file_hash, extension, file_path))
+                duplicate = cursor.fetchone()
+                if duplicate:
+                    source_id, file_type, lines, total_tokens, priority, content_preview = duplicate
+                    cursor.execute("""
+                        SELECT content, tokens, start_line, end_line, chunk_type, chunk_hash FROM file_chunks
+                        WHERE file_id = ? ORDER BY chunk_index
+                    """, (source_id,))
+                    chunk_rows = cursor.fetchall()
             
-            # Extract content based on file type
-            content = self.extract_text_from_file(file_path)
+            if duplicate:
+                return {
+                    'file_meta': {
+                        'file_path': file_path,
+                        'file_hash': file_hash,
+                        'extension': extension,
+                        'file_type': file_type,
+                        'size': file_size,
+                        'lines': lines,
+                        'tokens': total_tokens,
+                        'priority': priority,
+                        'content_preview': content_preview
+                    },
+                    'chunks': [{
+                        'content': self._decompress(content),
+                        'tokens': tokens,
+                        'start_line': start_line,
+                        'end_line': end_line,
+                        'chunk_type': chunk_type,
+                        'chunk_hash': chunk_hash
+                    } for content, tokens, start_line, end_line, chunk_type, chunk_hash in chunk_rows]
+                }
+            
+            if extension in PARSED_EXTENSIONS and data is not None:
+                # Document parsers need a real file, so spill in-memory content to one
+                with tempfile.NamedTemporaryFile(suffix=extension, delete=False) as f:
+                    f.write(data)
+                try:
+                    chunks = self.smart_chunk_content(self.extract_text_from_file(f.name), extension)
+                finally:
+                    os.remove(f.name)
+            elif extension in PARSED_EXTENSIONS:
+                # Documents need a parser, so extract their text before chunking
+                chunks = self.smart_chunk_content(self.extract_text_from_file(file_path), extension)
+            elif data is not None:
+                chunks = self._chunk_lines(_decode_lines(io.BytesIO(data)), extension)
+            else:
+                # Plain text is decoded, split and chunked in a single streaming pass
+                chunks = self._chunk_lines(_read_text_lines(file_path), extension)
             
             # Skip if content is too large
-            total_tokens = self.count_tokens(content)
+            total_tokens = sum(chunk['tokens'] for chunk in chunks)
             if total_tokens > 100000:  # Increased limit for documents
-                st.warning(f"Skipping file with too many tokens: {os.path.basename(file_path)} ({total_tokens:,} tokens)")
-                return False
+                return {'warning': f"Skipping file with too many tokens: {os.path.basename(file_path)} ({total_tokens:,} tokens)"}
             
-            # Get file metadata
-            file_hash = hashlib.md5(content.encode()).hexdigest()
-            extension = Path(file_path).suffix.lower()
             
             # Determine file type
             if extension in ['.py', '.js', '.java', '.cpp', '.c', '.go', '.rs']:
@@ -545,181 +897,568 @@ class EnhancedCodebaseHandler:
             else:
                 file_type = 'other'
             
-            lines = len(content.split('\n'))
+            lines = chunks[-1]['end_line'] + 1 if chunks else 0
             priority = FILE_PRIORITY.get(extension, 1)
-            content_preview = content[:500] + "..." if len(content) > 500 else content
-            
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
             
-            # Insert/update file record
-            cursor.execute("""
-                INSERT OR REPLACE INTO files 
-                (file_path, file_hash, extension, file_type, size, lines, tokens, priority, 
-                 last_modified, is_processed, content_preview)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now'), TRUE, ?)
-            """, (file_path, file_hash, extension, file_type, file_size, lines, 
-                  total_tokens, priority, content_preview))
+            # Chunks partition the lines, so the preview is rebuilt from the leading chunks
+            preview_parts = []
+            preview_length = -1
+            for chunk in chunks:
+                if preview_length > 500:
+                    break
+                preview_parts.append(chunk['content'])
+                preview_length += len(chunk['content']) + 1
+            preview = '\n'.join(preview_parts)
+            content_preview = preview[:500] + "..." if len(preview) > 500 else preview
             
-            file_id = cursor.lastrowid
+            for chunk in chunks:
+                chunk['chunk_hash'] = hashlib.md5(chunk['content'].encode()).hexdigest()
             
-            # Delete old chunks
-            cursor.execute("DELETE FROM file_chunks WHERE file_id = ?", (file_id,))
+            return {
+                'file_meta': {
+                    'file_path': file_path,
+                    'file_hash': file_hash,
+                    'extension': extension,
+                    'file_type': file_type,
+                    'size': file_size,
+                    'lines': lines,
+                    'tokens': total_tokens,
+                    'priority': priority,
+                    'content_preview': content_preview
+                },
+                'chunks': chunks
+            }
             
-            # Create smart chunks
-            chunks = self.smart_chunk_content(content, extension)
+        except Exception as e:
+            return {'error': f"Error processing {file_path}: {e}"}
+    
+    def _store_file(self, cursor, result: Dict) -> None:
+        """Write a prepared file and its chunks using the given cursor."""
+        meta = result['file_meta']
+        cursor.execute("UPDATE meta SET value = value + 1 WHERE key = 'corpus_version'")
+        
+        # Insert/update file record, keeping its id stable so old chunks can be replaced
+        cursor.execute("""
+            INSERT INTO files 
+            (file_path, file_hash, extension, file_type, size, lines, tokens, priority, 
+             last_modified, is_processed, content_preview)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now'), TRUE, ?)
+            ON CONFLICT(file_path) DO UPDATE SET
+                file_hash = excluded.file_hash, extension = excluded.extension,
+                file_type = excluded.file_type, size = excluded.size, lines = excluded.lines,
+                tokens = excluded.tokens, priority = excluded.priority,
+                last_modified = excluded.last_modified, is_processed = excluded.is_processed,
+                content_preview = excluded.content_preview
+        """, (meta['file_path'], meta['file_hash'], meta['extension'], meta['file_type'], meta['size'],
+              meta['lines'], meta['tokens'], meta['priority'], meta['content_preview']))
+        
+        cursor.execute("SELECT id FROM files WHERE file_path = ?", (meta['file_path'],))
+        file_id = cursor.fetchone()[0]
+        
+        # Diff against stored chunks by hash so unchanged chunks keep their embeddings
+        old_chunks = {}
+        cursor.execute("SELECT id, chunk_hash FROM file_chunks WHERE file_id = ?", (file_id,))
+        for chunk_id, chunk_hash in cursor.fetchall():
+            old_chunks.setdefault(chunk_hash, []).append(chunk_id)
+        
+        kept, rows = [], []
+        for chunk_idx, chunk in enumerate(result['chunks']):
+            old_ids = old_chunks.get(chunk['chunk_hash'])
+            if old_ids:
+                kept.append((chunk_idx, chunk['tokens'], chunk['start_line'], chunk['end_line'],
+                             chunk['chunk_type'], old_ids.pop()))
+            else:
+                rows.append((file_id, chunk_idx, self._compress(chunk['content']), chunk['tokens'],
+                             chunk['start_line'], chunk['end_line'], chunk['chunk_type'], chunk['chunk_hash']))
+        
+        # Removed chunks take their embeddings with them via ON DELETE CASCADE
+        cursor.executemany("DELETE FROM file_chunks WHERE id = ?",
+                           [(chunk_id,) for old_ids in old_chunks.values() for chunk_id in old_ids])
+        cursor.executemany("""
+            UPDATE file_chunks
+            SET chunk_index = ?, tokens = ?, start_line = ?, end_line = ?, chunk_type = ?
+            WHERE id = ?
+        """, kept)
+        cursor.executemany("""
+            INSERT INTO file_chunks 
+            (file_id, chunk_index, content, tokens, start_line, end_line, chunk_type, chunk_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        
+        # New chunks whose content is already embedded elsewhere share that matrix row
+        if rows:
+            cursor.execute("""
+                INSERT INTO embeddings (chunk_id, row_index, scale)
+                SELECT fc.id, e.row_index, e.scale
+                FROM file_chunks fc
+                JOIN file_chunks other ON other.chunk_hash = fc.chunk_hash AND other.id != fc.id
+                JOIN embeddings e ON e.chunk_id = other.id
+                WHERE fc.file_id = ? AND fc.id NOT IN (SELECT chunk_id FROM embeddings)
+                GROUP BY fc.id
+            """, (file_id,))
+    
+    def process_files(self, file_paths: List[str], max_workers: int = None,
+                      max_concurrent_results: int = 32, progress_callback=None,
+                      rows_per_transaction: int = 1000) -> int:
+        """Process many files in parallel, serializing database writes on the calling thread.
+        
+        Extraction and chunking run in a thread pool; at most ``max_concurrent_results``
+        prepared files are held in memory at once. Items are paths or ``(name, data)`` pairs
+        for in-memory files. Prepared files are written in transactions of roughly
+        ``rows_per_transaction`` chunk rows. ``progress_callback(done, total, file_path, ok)``
+        is called on the calling thread after each file. Returns the number of stored files.
+        """
+        if not file_paths:
+            return 0
+        
+        max_workers = max_workers or min(os.cpu_count() or 1, 8)
+        max_file_size = st.session_state.max_file_size
+        total_files = len(file_paths)
+        pending_paths = iter(file_paths)
+        processed_count = 0
+        done_count = 0
+        pending_writes = []
+        pending_rows = 0
+        claimed = set()
+        claimed_lock = threading.Lock()
+        deferred = []
+        
+        def claim(key):
+            with claimed_lock:
+                if key in claimed:
+                    return False
+                claimed.add(key)
+                return True
+        
+        def report(file_path, ok):
+            nonlocal done_count
+            done_count += 1
+            if progress_callback:
+                progress_callback(done_count, total_files, file_path, ok)
+        
+        def flush():
+            nonlocal processed_count, pending_rows
+            if not pending_writes:
+                return
             
-            for chunk_idx, chunk in enumerate(chunks):
-                chunk_hash = hashlib.md5(chunk['content'].encode()).hexdigest()
-                cursor.execute("""
-                    INSERT INTO file_chunks 
-                    (file_id, chunk_index, content, tokens, start_line, end_line, chunk_type, chunk_hash)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (file_id, chunk_idx, chunk['content'], chunk['tokens'],
-                      chunk['start_line'], chunk['end_line'], chunk['chunk_type'], chunk_hash))
+            try:
+                with self._transaction() as cursor:
+                    for _, result in pending_writes:
+                        self._store_file(cursor, result)
+                stored = [(file_path, True) for file_path, _ in pending_writes]
+            except Exception:
+                # Retry one file per transaction so a single bad file doesn't sink the batch
+                stored = []
+                for file_path, result in pending_writes:
+                    try:
+                        with self._transaction() as cursor:
+                            self._store_file(cursor, result)
+                        stored.append((file_path, True))
+                    except Exception as e:
+                        st.warning(f"Error processing {file_path}: {e}")
+                        stored.append((file_path, False))
             
-            conn.commit()
-            conn.close()
-            return True
+            for file_path, ok in stored:
+                if ok:
+                    processed_count += 1
+                report(file_path, ok)
+            pending_writes.clear()
+            pending_rows = 0
+        
+        def handle(file_path, result):
+            nonlocal processed_count, pending_rows
+            if 'unchanged' in result:
+                processed_count += 1
+                report(file_path, True)
+            elif 'warning' in result:
+                st.warning(result['warning'])
+                report(file_path, False)
+            elif 'error' in result:
+                st.session_state.file_processing_error = result['error']
+                st.warning(result['error'])
+                report(file_path, False)
+            else:
+                pending_writes.append((file_path, result))
+                pending_rows += len(result['chunks']) + 1
+                if pending_rows >= rows_per_transaction:
+                    flush()
+        
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                in_flight = {}
+                
+                def submit_next():
+                    item = next(pending_paths, None)
+                    if item is not None:
+                        file_path, data = item if isinstance(item, tuple) else (item, None)
+                        future = executor.submit(self._prepare_file, file_path, max_file_size, data, claim)
+                        in_flight[future] = (file_path, data)
+                
+                for _ in range(max_concurrent_results):
+                    submit_next()
+                
+                while in_flight:
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        file_path, data = in_flight.pop(future)
+                        submit_next()
+                        
+                        result = future.result()
+                        if 'duplicate' in result:
+                            # Same content as another file in this batch; copy it once that file is stored
+                            deferred.append((file_path, data))
+                        else:
+                            handle(file_path, result)
+                
+                flush()
             
-        except Exception as e:
-            st.session_state.file_processing_error = f"Error processing {file_path}: {e}"
-            return False
+            for file_path, data in deferred:
+                handle(file_path, self._prepare_file(file_path, max_file_size, data))
+            flush()
+        finally:
+            self._matrix_dirty = True
+        
+        return processed_count
     
     def get_relevant_files(self, query: str, max_tokens: int) -> List[Dict]:
         """Get most relevant files within token limit using intelligent selection."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        return self._relevant_files_cache(query.lower().strip(), max_tokens, self._corpus_version())
+    
+    def _get_relevant_files(self, query: str, max_tokens: int, corpus_version: int) -> List[Dict]:
+        """Uncached file selection for a normalized query and corpus version.
         
-        cursor.execute("""
-            SELECT file_path, extension, tokens, priority, file_type, content_preview
-            FROM files 
-            WHERE is_processed = TRUE 
-            ORDER BY priority DESC, tokens ASC
-        """)
+        Files with tokens starting with a query keyword are ranked by BM25 over the full-text index;
+        the remaining budget is filled with the highest-priority files.
+        """
+        keywords = WORD_PATTERN.findall(query)
+        match_query = ' OR '.join('"' + keyword.replace('"', '""') + '"*' for keyword in keywords)
         
-        files = cursor.fetchall()
-        conn.close()
+        with self._lock:
+            cursor = self.conn.cursor()
+            
+            matches = []
+            if match_query:
+                cursor.execute("""
+                    SELECT f.file_path, f.tokens, f.priority, f.file_type, bm25(files_fts) AS score
+                    FROM files_fts
+                    JOIN files f ON files_fts.rowid = f.id
+                    WHERE files_fts MATCH ? AND f.is_processed = TRUE
+                    ORDER BY score, f.priority DESC
+                    LIMIT 25
+                """, (match_query,))
+                matches = cursor.fetchall()
+            
+            cursor.execute("""
+                SELECT file_path, tokens, priority, file_type, 0.0
+                FROM files 
+                WHERE is_processed = TRUE 
+                ORDER BY priority DESC, tokens ASC
+            """)
+            
+            selected_files = []
+            selected_paths = set()
+            current_tokens = 0
+            for rows in (matches, cursor):
+                for file_path, tokens, priority, file_type, score in rows:
+                    if len(selected_files) >= 25:
+                        break
+                    if file_path in selected_paths or current_tokens + tokens > max_tokens:
+                        continue
+                    
+                    selected_files.append({
+                        'file_path': file_path,
+                        'tokens': tokens,
+                        'priority': priority,
+                        'relevance_score': -score,  # bm25() is lower for better matches
+                        'file_type': file_type
+                    })
+                    selected_paths.add(file_path)
+                    current_tokens += tokens
         
-        if not files:
-            return []
+        return selected_files
+    
+    def _matrix_row_count(self) -> int:
+        """Number of embedding rows stored in the matrix file."""
+        if not os.path.exists(self.matrix_path):
+            return 0
+        return os.path.getsize(self.matrix_path) // (EMBEDDING_DIM * np.dtype(EMBEDDING_DTYPE).itemsize)
+    
+    def _truncate_matrix_tail(self) -> int:
+        """Drop a partially written trailing row from the matrix file and return the row count.
         
-        # Simple relevance scoring based on query keywords
-        query_keywords = set(query.lower().split())
-        selected_files = []
-        current_tokens = 0
+        Must be called with the database write lock held.
+        """
+        rows = self._matrix_row_count()
+        row_bytes = EMBEDDING_DIM * np.dtype(EMBEDDING_DTYPE).itemsize
+        if os.path.exists(self.matrix_path) and os.path.getsize(self.matrix_path) != rows * row_bytes:
+            os.truncate(self.matrix_path, rows * row_bytes)
+        return rows
+    
+    def _open_chunk_matrix(self):
+        """Memory-map the embedding matrix file; pages are loaded only when rows are touched."""
+        rows = self._matrix_row_count()
+        if rows == 0:
+            self._chunk_matrix = np.zeros((0, EMBEDDING_DIM), dtype=EMBEDDING_DTYPE)
+        else:
+            self._chunk_matrix = np.memmap(self.matrix_path, dtype=EMBEDDING_DTYPE, mode='r',
+                                           shape=(rows, EMBEDDING_DIM))
+    
+    def _get_or_compute_embedding_rows(self, chunk_ids: List[int], contents: List[str],
+                                       query: Optional[str] = None) -> Tuple[List[int], Optional[np.ndarray]]:
+        """Return matrix rows for chunk embeddings, encoding only chunks missing from the cache.
         
-        for file_path, extension, tokens, priority, file_type, content_preview in files:
-            if current_tokens + tokens > max_tokens:
-                break
-                
-            filename = os.path.basename(file_path).lower()
+        When a query is given and chunks need encoding, it rides along in the same batch
+        and its embedding is returned as well.
+        """
+        model = load_embeddings_model()
+        
+        # Look up cached embedding rows
+        cached = {}
+        with self._lock:
+            cursor = self.conn.cursor()
+            for start in range(0, len(chunk_ids), 500):
+                batch_ids = chunk_ids[start:start + 500]
+                placeholders = ','.join(['?' for _ in batch_ids])
+                cursor.execute(f"""
+                    SELECT chunk_id, row_index FROM embeddings
+                    WHERE chunk_id IN ({placeholders})
+                """, batch_ids)
+                cached.update(cursor.fetchall())
+        
+        # Encode the remainder in a single batched call and append it to the matrix file;
+        # chunks with identical text are encoded once and share a matrix row
+        groups = {}
+        for i, chunk_id in enumerate(chunk_ids):
+            if chunk_id not in cached:
+                groups.setdefault(contents[i][:1000], []).append(chunk_id)
+        query_embedding = None
+        if groups:
+            texts = list(groups)
+            if query is not None:
+                texts.insert(0, query)
+            new_embeddings = model.encode(texts, batch_size=64, convert_to_numpy=True,
+                                          normalize_embeddings=True, show_progress_bar=False)
+            if query is not None:
+                query_embedding = np.asarray(new_embeddings[0], dtype=np.float32)
+                new_embeddings = new_embeddings[1:]
             
-            # Calculate relevance score
-            relevance_score = 0
-            if any(keyword in filename for keyword in query_keywords):
-                relevance_score += 10
-            if extension[1:] in query_keywords:
-                relevance_score += 5
-            if any(keyword in file_type for keyword in query_keywords):
-                relevance_score += 3
-            if any(keyword in content_preview.lower() for keyword in query_keywords):
-                relevance_score += 7
+            # Symmetric int8 quantization, one scale per row
+            new_embeddings = np.asarray(new_embeddings, dtype=np.float32)
+            scales = np.abs(new_embeddings).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            new_embeddings = np.ascontiguousarray(
+                np.rint(new_embeddings / scales[:, None]), dtype=EMBEDDING_DTYPE
+            )
             
-            selected_files.append({
-                'file_path': file_path,
-                'tokens': tokens,
-                'priority': priority,
-                'relevance_score': relevance_score,
-                'file_type': file_type
-            })
-            current_tokens += tokens
+            # The immediate transaction doubles as the matrix file lock: appends from other
+            # handlers on the same database wait here, so row indices never collide
+            with self._transaction(immediate=True) as cursor:
+                # Chunks embedded by another handler since the lookup keep their existing rows
+                missing_ids = [chunk_id for group in groups.values() for chunk_id in group]
+                for start in range(0, len(missing_ids), 500):
+                    batch_ids = missing_ids[start:start + 500]
+                    placeholders = ','.join(['?' for _ in batch_ids])
+                    cursor.execute(f"""
+                        SELECT chunk_id, row_index FROM embeddings
+                        WHERE chunk_id IN ({placeholders})
+                    """, batch_ids)
+                    cached.update(cursor.fetchall())
+                keep = [(offset, [chunk_id for chunk_id in group if chunk_id not in cached])
+                        for offset, group in enumerate(groups.values())]
+                keep = [(offset, group) for offset, group in keep if group]
+                
+                first_row = self._truncate_matrix_tail()
+                with open(self.matrix_path, 'ab') as f:
+                    f.write(new_embeddings[[offset for offset, _ in keep]].tobytes())
+                
+                rows = []
+                for row, (offset, group) in enumerate(keep, start=first_row):
+                    for chunk_id in group:
+                        cached[chunk_id] = row
+                        rows.append((chunk_id, row, float(scales[offset])))
+                cursor.executemany("INSERT INTO embeddings (chunk_id, row_index, scale) VALUES (?, ?, ?)", rows)
+            self._chunk_matrix = None
+        
+        return [cached[chunk_id] for chunk_id in chunk_ids], query_embedding
+    
+    def _refresh_chunk_matrix(self, query: Optional[str] = None) -> Optional[np.ndarray]:
+        """Embed new chunks and reopen the embedding matrix after chunks are inserted.
+        
+        Chunks stored through other handlers on the same database are picked up via the
+        corpus version. Returns the query embedding if the query was encoded alongside new chunks.
+        """
+        corpus_version = self._corpus_version()
+        if not self._matrix_dirty and self._chunk_matrix is not None and corpus_version == self._matrix_version:
+            return None
+        
+        with self._transaction(immediate=True) as cursor:
+            # Rows past the end of the matrix file are re-embedded below
+            cursor.execute("DELETE FROM embeddings WHERE row_index >= ?", (self._matrix_row_count(),))
+        
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("""
+                SELECT id, content FROM file_chunks
+                WHERE id NOT IN (SELECT chunk_id FROM embeddings)
+                ORDER BY id
+            """)
+            missing = cursor.fetchall()
+        
+        query_embedding = None
+        if missing:
+            _, query_embedding = self._get_or_compute_embedding_rows(
+                [row[0] for row in missing], [self._decompress(row[1]) for row in missing], query
+            )
+        
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("""
+                SELECT e.chunk_id, e.row_index, e.scale FROM embeddings e
+                JOIN file_chunks fc ON fc.id = e.chunk_id
+                ORDER BY e.chunk_id
+            """)
+            live_rows = cursor.fetchall()
+        
+        self._open_chunk_matrix()
+        # Another handler may have reset the matrix since the rows were read
+        live_rows = [live for live in live_rows if live[1] < len(self._chunk_matrix)]
+        self._chunk_ids = [chunk_id for chunk_id, _, _ in live_rows]
+        self._chunk_rows = {chunk_id: row for chunk_id, row, _ in live_rows}
+        self._row_scales = np.zeros(len(self._chunk_matrix), dtype=np.float32)
+        if live_rows:
+            self._row_scales[[row for _, row, _ in live_rows]] = [scale for _, _, scale in live_rows]
         
-        # Sort by relevance and priority
-        selected_files.sort(key=lambda x: (x['relevance_score'], x['priority']), reverse=True)
-        return selected_files[:25]
+        self._matrix_dirty = False
+        self._matrix_version = corpus_version
+        return query_embedding
+    
+    def embed_pending_chunks(self):
+        """Embed every chunk stored since the last refresh in one batched encode call."""
+        if load_embeddings_model():
+            self._refresh_chunk_matrix()
     
     def get_relevant_chunks(self, query: str, file_paths: List[str], max_tokens: int) -> List[Dict]:
         """Get most relevant chunks from selected files."""
-        if not st.session_state.embeddings_model:
+        if not load_embeddings_model():
             return []
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        return self._relevant_chunks_cache(query.lower().strip(), tuple(file_paths), max_tokens, self._corpus_version())
+    
+    def _get_relevant_chunks(self, query: str, file_paths: tuple, max_tokens: int, corpus_version: int) -> List[Dict]:
+        """Uncached chunk retrieval, reusing results of near-duplicate recent queries."""
+        # Embeddings are L2-normalized, so dot products are cosine similarities.
+        # Pending chunk embeddings are computed in the same encode call as the query.
+        query_embedding = self._refresh_chunk_matrix(query)
+        if query_embedding is None:
+            query_embedding = load_embeddings_model().encode(
+                [query], convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False
+            )[0].astype(np.float32)
+        
+        scope = (file_paths, max_tokens, corpus_version)
+        recent = [(embedding, result) for embedding, recent_scope, result in self._recent_queries
+                  if recent_scope == scope]
+        if recent:
+            similarities = np.stack([embedding for embedding, _ in recent]) @ query_embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] > 0.97:
+                return recent[best][1]
         
-        # Get chunks from selected files
-        placeholders = ','.join(['?' for _ in file_paths])
-        cursor.execute(f"""
-            SELECT fc.id, fc.content, fc.tokens, fc.start_line, fc.chunk_type, f.file_path
-            FROM file_chunks fc
-            JOIN files f ON fc.file_id = f.id
-            WHERE f.file_path IN ({placeholders})
-            ORDER BY fc.tokens ASC
-        """, file_paths)
+        with self._lock:
+            cursor = self.conn.cursor()
         
-        chunks = cursor.fetchall()
-        conn.close()
+            # Get chunks from selected files
+            placeholders = ','.join(['?' for _ in file_paths])
+            cursor.execute(f"""
+                SELECT fc.id, fc.content, fc.tokens, fc.start_line, fc.chunk_type, f.file_path
+                FROM file_chunks fc
+                JOIN files f ON fc.file_id = f.id
+                WHERE f.file_path IN ({placeholders})
+                ORDER BY fc.tokens ASC
+            """, file_paths)
+        
+            chunks = cursor.fetchall()
         
         if not chunks:
             return []
         
-        # Create query embedding
-        query_embedding = st.session_state.embeddings_model.encode([query])[0]
-        
-        # Calculate similarities for chunks
-        relevant_chunks = []
+        # Keep the smallest chunks that fit in the token budget
+        candidates = []
         current_tokens = 0
-        
-        for chunk_id, content, tokens, start_line, chunk_type, file_path in chunks:
-            if current_tokens + tokens > max_tokens:
+        for chunk in chunks:
+            if current_tokens + chunk[2] > max_tokens:
                 break
-            
-            # Create chunk embedding
-            chunk_embedding = st.session_state.embeddings_model.encode([content[:1000]])[0]
-            similarity = cosine_similarity([query_embedding], [chunk_embedding])[0][0]
-            
+            candidates.append(chunk)
+            current_tokens += chunk[2]
+        
+        if not candidates:
+            return []
+        
+        self._refresh_chunk_matrix()
+        if any(chunk[0] not in self._chunk_rows for chunk in candidates):
+            self._matrix_dirty = True
+            self._refresh_chunk_matrix()
+            # Chunks removed by another session in the meantime are skipped
+            candidates = [chunk for chunk in candidates if chunk[0] in self._chunk_rows]
+            if not candidates:
+                return []
+        
+        rows = np.fromiter((self._chunk_rows[chunk[0]] for chunk in candidates),
+                           dtype=np.int64, count=len(candidates))
+        top_k = min(15, len(candidates))
+        
+        # A single matrix-vector product over the int8 candidate rows, accumulated in float32
+        scores = np.einsum('ij,j->i', self._chunk_matrix[rows], query_embedding, dtype=np.float32)
+        scores *= self._row_scales[rows]
+        
+        # Partial top-k selection instead of a full sort
+        if len(candidates) > top_k:
+            top = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            top = np.arange(len(candidates))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        
+        relevant_chunks = []
+        for idx in top:
+            chunk_id, content, tokens, start_line, chunk_type, file_path = candidates[idx]
             relevant_chunks.append({
                 'chunk_id': chunk_id,
-                'content': content,
+                'content': self._decompress(content),
                 'tokens': tokens,
                 'start_line': start_line,
                 'chunk_type': chunk_type,
                 'file_path': file_path,
-                'similarity': similarity
+                'similarity': float(scores[idx])
             })
-            current_tokens += tokens
         
-        # Sort by similarity
-        relevant_chunks.sort(key=lambda x: x['similarity'], reverse=True)
-        return relevant_chunks[:15]
+        self._recent_queries.append((query_embedding, scope, relevant_chunks))
+        return relevant_chunks
     
     def get_codebase_summary(self) -> Dict:
         """Get comprehensive codebase statistics."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._lock:
+            cursor = self.conn.cursor()
         
-        cursor.execute("SELECT COUNT(*), SUM(lines), SUM(tokens), SUM(size) FROM files WHERE is_processed = TRUE")
-        total_files, total_lines, total_tokens, total_size = cursor.fetchone()
+            cursor.execute("SELECT COUNT(*), SUM(lines), SUM(tokens), SUM(size) FROM files WHERE is_processed = TRUE")
+            total_files, total_lines, total_tokens, total_size = cursor.fetchone()
         
-        cursor.execute("""
-            SELECT file_type, COUNT(*) as count, SUM(lines) as lines, SUM(tokens) as tokens
-            FROM files 
-            WHERE is_processed = TRUE 
-            GROUP BY file_type 
-            ORDER BY count DESC
-        """)
-        file_types = {row[0]: {'count': row[1], 'lines': row[2], 'tokens': row[3]} for row in cursor.fetchall()}
+            cursor.execute("""
+                SELECT file_type, COUNT(*) as count, SUM(lines) as lines, SUM(tokens) as tokens
+                FROM files 
+                WHERE is_processed = TRUE 
+                GROUP BY file_type 
+                ORDER BY count DESC
+            """)
+            file_types = {row[0]: {'count': row[1], 'lines': row[2], 'tokens': row[3]} for row in cursor.fetchall()}
         
-        cursor.execute("""
-            SELECT extension, COUNT(*) as count
-            FROM files 
-            WHERE is_processed = TRUE 
-            GROUP BY extension 
-            ORDER BY count DESC
-        """)
-        extensions = {row[0]: row[1] for row in cursor.fetchall()}
+            cursor.execute("""
+                SELECT extension, COUNT(*) as count
+                FROM files 
+                WHERE is_processed = TRUE 
+                GROUP BY extension 
+                ORDER BY count DESC
+            """)
+            extensions = {row[0]: row[1] for row in cursor.fetchall()}
         
-        conn.close()
         
         return {
             'total_files': total_files or 0,
@@ -730,28 +1469,182 @@ class EnhancedCodebaseHandler:
             'extensions': extensions
         }
 
+# Embeddings model settings
+EMBEDDINGS_MODEL_REPO = "sentence-transformers/all-MiniLM-L6-v2"
+MODEL_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "llm_assistant")
+
+class OnnxSentenceEncoder:
+    """Quantized ONNX Runtime MiniLM exposing the SentenceTransformer encode API."""
+    
+    def __init__(self, model_path: str, tokenizer_name: str, max_seq_length: int = 256):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = os.cpu_count() or 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+        self.max_seq_length = max_seq_length
+    
+    def encode(self, sentences, batch_size: int = 32, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = False, show_progress_bar: bool = False) -> np.ndarray:
+        """Mean-pooled sentence embeddings, batched by similar length to minimize padding."""
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        if not sentences:
+            return np.zeros((0, 384), dtype=np.float32)
+        
+        # Smart batching: sort by length so each batch pads to a similar size
+        order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]), reverse=True)
+        embeddings = [None] * len(sentences)
+        
+        for start in range(0, len(order), batch_size):
+            batch_indices = order[start:start + batch_size]
+            encoded = self.tokenizer([sentences[i] for i in batch_indices], padding=True, truncation=True,
+                                     max_length=self.max_seq_length, return_tensors='np')
+            attention_mask = encoded['attention_mask'].astype(np.int64)
+            feeds = {
+                'input_ids': encoded['input_ids'].astype(np.int64),
+                'attention_mask': attention_mask
+            }
+            if 'token_type_ids' in self.input_names:
+                feeds['token_type_ids'] = encoded.get('token_type_ids', np.zeros_like(attention_mask)).astype(np.int64)
+            
+            token_embeddings = self.session.run(None, feeds)[0]
+            mask = attention_mask[..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if normalize_embeddings:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            
+            for row, index in enumerate(batch_indices):
+                embeddings[index] = pooled[row]
+        
+        result = np.stack(embeddings).astype(np.float32)
+        return result[0] if single else result
+
+def load_onnx_encoder() -> OnnxSentenceEncoder:
+    """Download the MiniLM ONNX export once, quantize it to int8 and open it."""
+    quantized_path = os.path.join(MODEL_CACHE_DIR, "minilm-int8.onnx")
+    if not os.path.exists(quantized_path):
+        os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+        onnx_path = hf_hub_download(EMBEDDINGS_MODEL_REPO, "onnx/model.onnx")
+        partial_path = quantized_path + ".partial"
+        quantize_dynamic(onnx_path, partial_path, weight_type=QuantType.QInt8)
+        os.replace(partial_path, quantized_path)
+    return OnnxSentenceEncoder(quantized_path, EMBEDDINGS_MODEL_REPO)
+
+def _load_sentence_transformer(device: str):
+    """Load the PyTorch MiniLM for inference, in FP16 on a GPU."""
+    model = SentenceTransformer('all-MiniLM-L6-v2', device=device)
+    if device == 'cuda':
+        model.half()
+    model.max_seq_length = 256  # Chunks are cut to 1000 characters before encoding
+    model.eval()
+    return model
+
+def _load_embeddings_backend() -> Tuple[Any, List[Tuple[str, str]]]:
+    """Load the embeddings model off the main thread, collecting messages for the UI."""
+    messages = []
+    
+    # On a CUDA host the FP16 PyTorch model beats the int8 CPU encoder
+    if SentenceTransformer is not None and torch.cuda.is_available():
+        try:
+            return _load_sentence_transformer('cuda'), messages
+        except Exception as e:
+            messages.append(('warning', f"GPU embeddings unavailable, falling back to CPU: {e}"))
+    
+    if ort is not None:
+        try:
+            return load_onnx_encoder(), messages
+        except Exception as e:
+            messages.append(('warning', f"ONNX embeddings unavailable, falling back to PyTorch: {e}"))
+    
+    if SentenceTransformer is not None:
+        try:
+            return _load_sentence_transformer('cpu'), messages
+        except Exception as e:
+            messages.append(('error', f"Failed to load embeddings model: {e}"))
+            return None, messages
+    
+    messages.append(('error', "No embeddings backend installed (install onnxruntime and transformers)"))
+    return None, messages
+
+@st.cache_resource
+def start_embeddings_preload():
+    """Start loading the embeddings model in a background thread, once per server."""
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embeddings-preload")
+    future = executor.submit(_load_embeddings_backend)
+    executor.shutdown(wait=False)
+    return future
+
 @st.cache_resource
 def load_embeddings_model():
-    """Load sentence transformer model for code embeddings with retry."""
-    try:
-        model = SentenceTransformer('all-MiniLM-L6-v2')
-        return model
-    except Exception as e:
-        st.error(f"Failed to load embeddings model: {e}")
-        # Try again with smaller model
-        try:
-            model = SentenceTransformer('all-MiniLM-L6-v2')
-            return model
-        except:
-            return None
+    """Load the code embeddings model, preferring the quantized ONNX encoder.
+    
+    Shared by every session; blocks only until the background preload finishes.
+    """
+    model, messages = start_embeddings_preload().result()
+    for level, message in messages:
+        getattr(st, level)(message)
+    return model
 
 def estimate_tokens(text: str) -> int:
-    """Estimate token count for text with fallback."""
-    try:
-        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        return len(encoding.encode(str(text)))
-    except:
-        return len(str(text)) // 4
+    """Estimate token count for text with the selected model's tokenizer, with fallback."""
+    return _estimate_tokens(str(text), st.session_state.get("model", "gpt-3.5-turbo"))
+
+@lru_cache(maxsize=8192)
+def _estimate_tokens(text: str, model: str) -> int:
+    """Count tokens for a string, caching repeated prompts and headers."""
+    encoding = get_encoding(model)
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4
+
+def message_tokens(msg: Dict) -> int:
+    """Token count of a chat message, cached on the message itself."""
+    if 'token_count' not in msg:
+        msg['token_count'] = estimate_tokens(msg['content'])
+    return msg['token_count']
+
+def parse_message_blocks(content: str) -> List[Tuple[bool, str, str]]:
+    """Split message content into (is_code, language, text) blocks on fenced code."""
+    blocks = []
+    position = 0
+    for match in CODE_BLOCK_PATTERN.finditer(content):
+        if match.start() > position:
+            blocks.append((False, '', content[position:match.start()]))
+        blocks.append((True, match.group(1).strip(), match.group(2)))
+        position = match.end()
+    if position < len(content):
+        blocks.append((False, '', content[position:]))
+    return blocks
+
+def block_keys(blocks: List[Tuple[bool, str, str]]) -> List[str]:
+    """Stable content digests used as widget keys for each block."""
+    return [hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest() for _, _, text in blocks]
+
+def message_blocks(msg: Dict) -> List[Tuple[bool, str, str]]:
+    """Parsed display blocks of a chat message, cached on the message itself."""
+    if '_parsed' not in msg:
+        msg['_parsed'] = parse_message_blocks(msg['content'])
+    return msg['_parsed']
+
+def message_block_keys(msg: Dict) -> List[str]:
+    """Widget keys for a message's blocks, cached on the message itself."""
+    if '_block_keys' not in msg:
+        msg['_block_keys'] = block_keys(message_blocks(msg))
+    return msg['_block_keys']
+
+def add_message(role: str, content: str):
+    """Append a chat message along with its token count, parsed blocks and block keys."""
+    blocks = parse_message_blocks(content)
+    st.session_state.messages.append({
+        "role": role,
+        "content": content,
+        "token_count": estimate_tokens(content),
+        "_parsed": blocks,
+        "_block_keys": block_keys(blocks)
+    })
 
 def get_system_prompt() -> str:
     """Enhanced system prompt for coding tasks."""
@@ -788,28 +1681,30 @@ def manage_context_window(messages: List[Dict], max_tokens: int) -> List[Dict]:
         return messages
     
     total_tokens = 0
-    kept_messages = []
     
     # Always keep system message
     system_msg = None
     if messages and messages[0].get('role') == 'system':
         system_msg = messages[0]
-        total_tokens += estimate_tokens(system_msg['content'])
+        total_tokens += message_tokens(system_msg)
     
     # Always keep the last user message
     last_user_msg = None
     if messages and messages[-1].get('role') == 'user':
         last_user_msg = messages[-1]
-        total_tokens += estimate_tokens(last_user_msg['content'])
-    
-    # Add messages from most recent backwards
-    for msg in reversed(messages[1:-1] if len(messages) > 2 else []):
-        msg_tokens = estimate_tokens(msg['content'])
-        if total_tokens + msg_tokens <= max_tokens:
-            kept_messages.insert(0, msg)
-            total_tokens += msg_tokens
-        else:
+        total_tokens += message_tokens(last_user_msg)
+    
+    # Walk back from the most recent message to find where the budget runs out,
+    # then keep everything after that point as a single slice
+    middle = messages[1:-1] if len(messages) > 2 else []
+    split = len(middle)
+    while split > 0:
+        msg_tokens = message_tokens(middle[split - 1])
+        if total_tokens + msg_tokens > max_tokens:
             break
+        total_tokens += msg_tokens
+        split -= 1
+    kept_messages = middle[split:]
     
     # Reconstruct message list
     final_messages = []
@@ -821,10 +1716,13 @@ def manage_context_window(messages: List[Dict], max_tokens: int) -> List[Dict]:
     
     return final_messages
 
-def create_intelligent_context(query: str, codebase_handler: EnhancedCodebaseHandler, max_tokens: int) -> str:
-    """Create intelligent context for the query within token limits."""
+def create_intelligent_context(query: str, codebase_handler: EnhancedCodebaseHandler, max_tokens: int) -> Tuple[str, bool]:
+    """Create intelligent context for the query within token limits.
+    
+    Returns the context and whether it was built without errors.
+    """
     if not codebase_handler:
-        return ""
+        return "", True
     
     # Reserve tokens for different parts
     summary_tokens = max_tokens * 0.2
@@ -854,96 +1752,288 @@ def create_intelligent_context(query: str, codebase_handler: EnhancedCodebaseHan
         # 2. Relevant files
         relevant_files = codebase_handler.get_relevant_files(query, int(files_tokens))
         if relevant_files:
-            files_context = "\n**Relevant Files:**\n"
+            # Accumulate pieces against a running budget instead of re-counting a growing string
+            files_parts = ["\n**Relevant Files:**\n"]
+            used_tokens = estimate_tokens(files_parts[0])
             for file_info in relevant_files[:8]:  # Reduced to top 8 files
-                files_context += f"- {file_info['file_path']} ({file_info['file_type']}, {file_info['tokens']:,} tokens)\n"
+                line = f"- {file_info['file_path']} ({file_info['file_type']}, {file_info['tokens']:,} tokens)\n"
+                line_tokens = estimate_tokens(line)
+                if used_tokens + line_tokens > files_tokens:
+                    break
+                files_parts.append(line)
+                used_tokens += line_tokens
             
-            if estimate_tokens(files_context) <= files_tokens:
-                context_parts.append(files_context)
+            if len(files_parts) > 1:
+                context_parts.append("".join(files_parts))
         
         # 3. Relevant code chunks (only if we have embeddings model)
-        if st.session_state.embeddings_model and relevant_files:
+        if relevant_files and load_embeddings_model():
             file_paths = [f['file_path'] for f in relevant_files[:4]]  # Top 4 files
             relevant_chunks = codebase_handler.get_relevant_chunks(query, file_paths, int(chunks_tokens))
             
             if relevant_chunks:
-                chunks_context = "\n**Most Relevant Code/Content Sections:**\n"
-                for i, chunk in enumerate(relevant_chunks[:4]):  # Top 4 chunks
-                    chunks_context += f"\n**File: {chunk['file_path']} (Line {chunk['start_line']})**\n"
+                chunks_parts = ["\n**Most Relevant Code/Content Sections:**\n"]
+                used_tokens = estimate_tokens(chunks_parts[0])
+                for chunk in relevant_chunks[:4]:  # Top 4 chunks
                     content = chunk['content']
                     if len(content) > 800:  # More aggressive truncation
                         content = content[:400] + "\n... (truncated) ...\n" + content[-400:]
-                    chunks_context += f"```\n{content}\n```\n"
+                    piece = f"\n**File: {chunk['file_path']} (Line {chunk['start_line']})**\n```\n{content}\n```\n"
+                    piece_tokens = estimate_tokens(piece)
+                    if used_tokens + piece_tokens > chunks_tokens:
+                        continue
+                    chunks_parts.append(piece)
+                    used_tokens += piece_tokens
                 
-                chunks_tokens_actual = estimate_tokens(chunks_context)
-                if chunks_tokens_actual <= chunks_tokens:
-                    context_parts.append(chunks_context)
+                if len(chunks_parts) > 1:
+                    context_parts.append("".join(chunks_parts))
     
     except Exception as e:
         st.error(f"Error creating context: {str(e)}")
+        return "\n".join(context_parts), False
     
-    return "\n".join(context_parts)
+    return "\n".join(context_parts), True
 
-def call_llm_api(messages: List[Dict], api_key: str, model: str, temperature: float, max_tokens: int) -> Optional[str]:
-    """Call Groq API with enhanced error handling and retry logic."""
-    headers = {
-        "Authorization": f"Bearer {api_key}",
+def build_system_message(query: str, codebase_handler: EnhancedCodebaseHandler, max_tokens: int) -> Dict:
+    """System prompt with codebase context, reused while the query, model and codebase are unchanged."""
+    query_hash = hashlib.blake2b(query.lower().strip().encode('utf-8'), digest_size=16).hexdigest()
+    key = (query_hash, st.session_state.model,
+           codebase_handler._corpus_version() if codebase_handler else None, max_tokens)
+    cache = st.session_state.setdefault('_system_message_cache', {})
+    if key in cache:
+        return cache[key]
+    
+    context, complete = create_intelligent_context(query, codebase_handler, max_tokens)
+    
+    # The fixed prompt and codebase overview lead, so the prefix stays identical across turns
+    system_prompt = get_system_prompt()
+    if context:
+        system_prompt += f"\n\n**Current Codebase Context:**\n{context}"
+    message = {"role": "system", "content": system_prompt}
+    message_tokens(message)
+    
+    # Partial context from a failed build is used once but never cached
+    if not complete:
+        return message
+    if len(cache) >= 16:
+        cache.pop(next(iter(cache)))
+    cache[key] = message
+    return message
+
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """Shared HTTP session so API calls reuse pooled keep-alive connections."""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
+    session.headers.update({
         "Content-Type": "application/json",
         "User-Agent": "LLM-Code-Assistant/1.0"
-    }
+    })
+    return session
+
+def _show_message(level: str, message: str):
+    """Show a status message in the app."""
+    getattr(st, level)(message)
+
+def stream_llm_api(messages: List[Dict], api_key: str, model: str, temperature: float, max_tokens: int,
+                   notify=_show_message, cancel_event: Optional[threading.Event] = None) -> Iterator[str]:
+    """Stream a Groq chat completion, yielding content as it arrives, with retry logic.
+    
+    Status messages go through ``notify(level, message)`` so the stream can run off the
+    script thread; setting ``cancel_event`` stops it and closes the connection.
+    """
+    # The session is shared by every user, so the API key is sent per request
+    headers = {"Authorization": f"Bearer {api_key}"}
     
     payload = {
         "model": model,
-        "messages": messages,
+        "messages": [{"role": msg["role"], "content": msg["content"]} for msg in messages],
         "temperature": temperature,
         "max_tokens": max_tokens,
-        "stream": False
+        "stream": True
     }
     
     max_retries = 3
     backoff_factor = 1
-    timeout = 30  # seconds
+    timeout = 30  # seconds, per read while streaming
+    received = False
     
     for attempt in range(max_retries):
         try:
-            response = requests.post(
+            with get_http_session().post(
                 "https://api.groq.com/openai/v1/chat/completions",
                 headers=headers,
                 json=payload,
-                timeout=timeout
-            )
-            
-            response.raise_for_status()  # Raise exception for HTTP errors
-            
-            if response.status_code == 200:
-                result = response.json()
-                return result['choices'][0]['message']['content']
-            elif response.status_code == 429:
-                wait_time = backoff_factor * (2 ** attempt)
-                st.warning(f"Rate limit exceeded. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
-                continue
-            else:
-                error_msg = f"API Error {response.status_code}: {response.text}"
-                st.error(error_msg)
-                return None
+                timeout=timeout,
+                stream=True
+            ) as response:
+                if response.status_code == 429:
+                    wait_time = backoff_factor * (2 ** attempt)
+                    notify('warning', f"Rate limit exceeded. Retrying in {wait_time} seconds...")
+                    time.sleep(wait_time)
+                    continue
+                elif response.status_code != 200:
+                    error_msg = f"API Error {response.status_code}: {response.text}"
+                    notify('error', error_msg)
+                    return
+                
+                # Server-sent events: one "data: {json}" line per delta, ending with "data: [DONE]".
+                # SSE is always UTF-8, but requests falls back to ISO-8859-1 without a charset
+                response.encoding = 'utf-8'
+                for line in response.iter_lines(decode_unicode=True):
+                    if cancel_event is not None and cancel_event.is_set():
+                        return
+                    if not line or not line.startswith("data: "):
+                        continue
+                    data = line[len("data: "):]
+                    if data == "[DONE]":
+                        return
+                    choices = json.loads(data).get('choices')
+                    content = choices[0].get('delta', {}).get('content') if choices else None
+                    if content:
+                        received = True
+                        yield content
+                return
                 
         except requests.exceptions.Timeout:
-            st.warning(f"Request timed out. Attempt {attempt+1}/{max_retries}")
+            if received:
+                notify('error', "Response stream timed out")
+                return
+            notify('warning', f"Request timed out. Attempt {attempt+1}/{max_retries}")
             if attempt < max_retries - 1:
                 time.sleep(backoff_factor * (2 ** attempt))
             else:
-                st.error("API request timed out after multiple attempts")
-                return None
+                notify('error', "API request timed out after multiple attempts")
+                return
         except requests.exceptions.RequestException as e:
-            st.error(f"Request failed: {str(e)}")
-            return None
+            notify('error', f"Request failed: {str(e)}")
+            return
         except Exception as e:
-            st.error(f"Unexpected error: {str(e)}")
-            return None
+            notify('error', f"Unexpected error: {str(e)}")
+            return
+    
+    notify('error', "Failed to get response after multiple attempts")
+
+def start_llm_stream(messages: List[Dict], api_key: str, model: str, temperature: float, max_tokens: int) -> Dict:
+    """Run stream_llm_api on a background thread, feeding its output into a queue.
+    
+    Returns the in-flight state: the queue, a cancel event, the text received so far and the thread.
+    """
+    inflight = {'queue': queue.Queue(), 'cancel': threading.Event(), 'parts': []}
+    
+    def worker():
+        try:
+            for content in stream_llm_api(messages, api_key, model, temperature, max_tokens,
+                                          notify=lambda level, message: inflight['queue'].put((level, message)),
+                                          cancel_event=inflight['cancel']):
+                inflight['parts'].append(content)
+                inflight['queue'].put(('text', content))
+        except Exception as e:
+            inflight['queue'].put(('error', f"Unexpected error: {str(e)}"))
+        finally:
+            inflight['queue'].put((None, None))
+    
+    inflight['thread'] = threading.Thread(target=worker, daemon=True)
+    inflight['thread'].start()
+    return inflight
+
+def drain_llm_stream(inflight: Dict) -> Iterator[str]:
+    """Yield streamed text on the script thread, showing status messages as they arrive."""
+    while True:
+        kind, payload = inflight['queue'].get()
+        if kind is None:
+            return
+        if kind == 'text':
+            yield payload
+        else:
+            _show_message(kind, payload)
+
+# Compiled programs and written sources are reused across runs of the same code
+RUN_CACHE_DIR = os.path.join(MODEL_CACHE_DIR, "run")
+RUN_CACHE_MAX_ENTRIES = 64
+
+def get_run_dir(code: str, language: str) -> str:
+    """Persistent working directory for a (language, code) pair, evicting the least recently used."""
+    key = hashlib.blake2b(f"{language}\0{code}".encode('utf-8'), digest_size=16).hexdigest()
+    run_dir = os.path.join(RUN_CACHE_DIR, key)
+    is_new = not os.path.isdir(run_dir)
+    os.makedirs(run_dir, exist_ok=True)
+    os.utime(run_dir)  # Directory mtime tracks last use
+    
+    if is_new:
+        entries = [entry for entry in os.scandir(RUN_CACHE_DIR) if entry.is_dir()]
+        if len(entries) > RUN_CACHE_MAX_ENTRIES:
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:len(entries) - RUN_CACHE_MAX_ENTRIES]:
+                if entry.path != run_dir:
+                    shutil.rmtree(entry.path, ignore_errors=True)
     
-    st.error("Failed to get response after multiple attempts")
-    return None
+    return run_dir
+
+# Per-stream cap on captured program output
+RUN_OUTPUT_LIMIT = 1 << 20
+
+def _kill_process_tree(proc: subprocess.Popen):
+    """Kill a child started by run_process together with anything it spawned."""
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except (ProcessLookupError, PermissionError, OSError):
+        pass
+
+def run_process(cmd: List[str], timeout: int = 30, output_limit: int = RUN_OUTPUT_LIMIT) -> subprocess.CompletedProcess:
+    """Run a command with streamed, size-capped output capture.
+    
+    The child runs in its own process group so a timeout or runaway output kills the
+    whole tree; anything still running in the group when the child exits is killed too. Raises subprocess.TimeoutExpired like subprocess.run.
+    """
+    if os.name == 'posix':
+        group_kwargs = {'start_new_session': True}
+    else:
+        group_kwargs = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, **group_kwargs)
+    
+    outputs = {}
+    truncated = set()
+    
+    def drain(name, stream):
+        # Registered up front so output read so far survives a reader that never finishes
+        buf = outputs[name] = bytearray()
+        while True:
+            data = stream.read1(65536)
+            if not data:
+                break
+            if len(buf) < output_limit:
+                buf += data[:output_limit - len(buf)]
+                if len(buf) >= output_limit:
+                    truncated.add(name)
+                    _kill_process_tree(proc)
+    
+    # One reader thread per pipe keeps either stream from filling up and blocking the child
+    readers = [threading.Thread(target=drain, args=(name, stream), daemon=True)
+               for name, stream in (('stdout', proc.stdout), ('stderr', proc.stderr))]
+    for reader in readers:
+        reader.start()
+    
+    try:
+        proc.wait(timeout=timeout)
+    finally:
+        # Also reap background grandchildren, which would otherwise keep running and hold the pipes open
+        _kill_process_tree(proc)
+        proc.wait()
+        for reader in readers:
+            reader.join(timeout=5)
+    
+    def decode(name):
+        text = bytes(outputs.get(name, b'')).decode('utf-8', errors='replace').replace('\r\n', '\n')
+        if name in truncated:
+            text += f"\n... (output truncated at {output_limit // 1024} KiB, process killed)"
+        return text
+    
+    return subprocess.CompletedProcess(cmd, proc.returncode, decode('stdout'), decode('stderr'))
 
 def run_code(code: str, language: str) -> Dict:
     """Execute code in various programming languages."""
@@ -955,50 +2045,58 @@ def run_code(code: str, language: str) -> Dict:
     runner = lang_config['runner']
     
     try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Create temporary file
-            file_path = os.path.join(temp_dir, f"temp_code{extension}")
-            with open(file_path, 'w', encoding='utf-8') as f:
+        run_dir = get_run_dir(code, language)
+        
+        # Write the source once; later runs of the same code reuse it
+        file_path = os.path.join(run_dir, f"temp_code{extension}")
+        if not os.path.exists(file_path):
+            partial_path = f"{file_path}.{os.getpid()}.partial"
+            with open(partial_path, 'w', encoding='utf-8') as f:
                 f.write(code)
-            
-            # Execute based on language
-            if language == 'python':
-                result = subprocess.run([sys.executable, file_path], 
-                                      capture_output=True, text=True, timeout=30)
-            elif language == 'javascript':
-                result = subprocess.run(['node', file_path], 
-                                      capture_output=True, text=True, timeout=30)
-            elif language == 'java':
-                # Compile first
-                compile_result = subprocess.run(['javac', file_path], 
-                                              capture_output=True, text=True, timeout=30)
+            os.replace(partial_path, file_path)
+        
+        # Execute based on language
+        if language == 'python':
+            result = run_process([sys.executable, file_path])
+        elif language == 'javascript':
+            result = run_process(['node', file_path])
+        elif language == 'java':
+            # Compile first, unless classes from an earlier run are cached
+            classes_dir = os.path.join(run_dir, 'classes')
+            if not os.path.isdir(classes_dir):
+                build_dir = tempfile.mkdtemp(dir=run_dir)
+                compile_result = run_process(['javac', '-d', build_dir, file_path])
                 if compile_result.returncode != 0:
+                    shutil.rmtree(build_dir, ignore_errors=True)
                     return {"error": f"Compilation error: {compile_result.stderr}"}
-                
-                # Extract class name and run
-                class_name = os.path.splitext(os.path.basename(file_path))[0]
-                result = subprocess.run(['java', '-cp', temp_dir, class_name], 
-                                      capture_output=True, text=True, timeout=30)
-            elif language in ['cpp', 'c']:
-                # Compile first
-                executable_path = os.path.join(temp_dir, 'temp_executable')
+                try:
+                    os.replace(build_dir, classes_dir)
+                except OSError:
+                    shutil.rmtree(build_dir, ignore_errors=True)  # A concurrent run got there first
+            
+            # Extract class name and run
+            class_name = os.path.splitext(os.path.basename(file_path))[0]
+            result = run_process(['java', '-cp', classes_dir, class_name])
+        elif language in ['cpp', 'c']:
+            # Compile first, unless the executable from an earlier run is cached
+            executable_path = os.path.join(run_dir, 'temp_executable')
+            if not os.path.exists(executable_path):
+                partial_path = f"{executable_path}.{os.getpid()}.partial"
                 compiler = 'g++' if language == 'cpp' else 'gcc'
-                compile_result = subprocess.run([compiler, file_path, '-o', executable_path], 
-                                              capture_output=True, text=True, timeout=30)
+                compile_result = run_process([compiler, file_path, '-o', partial_path])
                 if compile_result.returncode != 0:
                     return {"error": f"Compilation error: {compile_result.stderr}"}
-                
-                result = subprocess.run([executable_path], 
-                                      capture_output=True, text=True, timeout=30)
-            else:
-                result = subprocess.run([runner, file_path], 
-                                      capture_output=True, text=True, timeout=30)
+                os.replace(partial_path, executable_path)
             
-            return {
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "returncode": result.returncode
-            }
+            result = run_process([executable_path])
+        else:
+            result = run_process([runner, file_path])
+        
+        return {
+            "stdout": result.stdout,
+            "stderr": result.stderr,
+            "returncode": result.returncode
+        }
             
     except subprocess.TimeoutExpired:
         return {"error": "Code execution timed out (30s limit)"}
@@ -1019,37 +2117,58 @@ def process_uploaded_files(uploaded_files, codebase_handler: EnhancedCodebaseHan
     processed_count = 0
     total_files = len(uploaded_files)
     
-    with tempfile.TemporaryDirectory() as temp_dir:
-        for i, uploaded_file in enumerate(uploaded_files):
-            try:
-                # Save uploaded file
-                file_path = os.path.join(temp_dir, uploaded_file.name)
-                with open(file_path, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
-                
-                # Process file
-                status_text.text(f"Processing: {uploaded_file.name}")
-                if codebase_handler.process_file(file_path):
-                    processed_count += 1
-                else:
-                    if st.session_state.file_processing_error:
-                        st.warning(st.session_state.file_processing_error)
-                
-                progress_bar.progress((i + 1) / total_files)
-                
-            except Exception as e:
-                st.error(f"Error processing {uploaded_file.name}: {e}")
+    def update_progress(done, total, file_path, ok):
+        status_text.text(f"Processed: {os.path.basename(file_path)} ({done}/{total})")
+        progress_bar.progress(done / total)
+    
+    # Uploads are already in memory, so chunk their bytes directly without a temp directory
+    uploads = [(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files]
+    try:
+        processed_count = codebase_handler.process_files(uploads, progress_callback=update_progress)
+    except Exception as e:
+        st.error(f"Error processing uploaded files: {e}")
     
     status_text.text(f"Processed {processed_count}/{total_files} files successfully")
     progress_bar.empty()
     status_text.empty()
     
     if processed_count > 0:
-        # Load embeddings after processing
-        st.session_state.embeddings_model = load_embeddings_model()
+        # Encode all new chunks in one batch
+        with st.spinner("Computing embeddings..."):
+            codebase_handler.embed_pending_chunks()
     
     return processed_count > 0
 
+def find_processable_files(directory_path: str) -> List[str]:
+    """Recursively list files with supported extensions using os.scandir, pruning skipped directories."""
+    files = []
+    pending_dirs = [directory_path]
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        try:
+            entries = list(os.scandir(current_dir))
+        except OSError:
+            continue
+        
+        subdirs = []
+        for entry in entries:
+            name = entry.name
+            if entry.is_dir():
+                # Skip common directories; like os.walk, don't descend into symlinked ones
+                if not entry.is_symlink() and name not in SKIP_DIRS:
+                    subdirs.append(entry.path)
+                continue
+            
+            # Same rule as Path.suffix: the text after the last dot, ignoring a leading one
+            dot = name.rfind('.')
+            if dot > 0 and name[dot:].lower() in ALL_EXTENSIONS:
+                files.append(entry.path)
+        
+        # Visit subdirectories in listing order, matching the top-down walk
+        pending_dirs.extend(reversed(subdirs))
+    
+    return files
+
 def process_directory(directory_path: str, codebase_handler: EnhancedCodebaseHandler) -> bool:
     """Process all files in a directory recursively."""
     if not os.path.exists(directory_path):
@@ -1057,15 +2176,7 @@ def process_directory(directory_path: str, codebase_handler: EnhancedCodebaseHan
         return False
     
     # Find all processable files
-    files_to_process = []
-    for root, dirs, files in os.walk(directory_path):
-        # Skip common directories
-        dirs[:] = [d for d in dirs if not d.startswith(('.git', '__pycache__', 'node_modules', '.venv', 'venv', '.vs', '.vscode'))]
-        
-        for file in files:
-            file_path = os.path.join(root, file)
-            if Path(file_path).suffix.lower() in ALL_EXTENSIONS:
-                files_to_process.append(file_path)
+    files_to_process = find_processable_files(directory_path)
     
     if not files_to_process:
         st.warning("No processable files found in directory")
@@ -1075,30 +2186,31 @@ def process_directory(directory_path: str, codebase_handler: EnhancedCodebaseHan
     progress_bar = st.progress(0)
     status_text = st.empty()
     
-    processed_count = 0
     total_files = len(files_to_process)
     
-    for i, file_path in enumerate(files_to_process):
-        try:
-            status_text.text(f"Processing: {os.path.basename(file_path)} ({i+1}/{total_files})")
-            if codebase_handler.process_file(file_path):
-                processed_count += 1
-            else:
-                if st.session_state.file_processing_error:
-                    st.warning(st.session_state.file_processing_error)
-            
-            progress_bar.progress((i + 1) / total_files)
-            
-        except Exception as e:
-            st.error(f"Error processing {file_path}: {e}")
+    def update_progress(done, total, file_path, ok):
+        status_text.text(f"Processed: {os.path.basename(file_path)} ({done}/{total})")
+        progress_bar.progress(done / total)
+    
+    # Reading and parsing is I/O bound, so overlap it across a thread pool
+    processed_count = 0
+    try:
+        processed_count = codebase_handler.process_files(
+            files_to_process,
+            max_workers=min(16, (os.cpu_count() or 1) * 2),
+            progress_callback=update_progress
+        )
+    except Exception as e:
+        st.error(f"Error processing {directory_path}: {e}")
     
     status_text.text(f"Processed {processed_count}/{total_files} files successfully")
     progress_bar.empty()
     status_text.empty()
     
     if processed_count > 0:
-        # Load embeddings after processing
-        st.session_state.embeddings_model = load_embeddings_model()
+        # Encode all new chunks in one batch
+        with st.spinner("Computing embeddings..."):
+            codebase_handler.embed_pending_chunks()
     
     return processed_count > 0
 
@@ -1109,9 +2221,17 @@ def main():
     if st.session_state.codebase_handler is None:
         st.session_state.codebase_handler = EnhancedCodebaseHandler()
     
-    # Load embeddings model on startup
-    if st.session_state.embeddings_model is None:
-        st.session_state.embeddings_model = load_embeddings_model()
+    # Start loading the embeddings model in the background without blocking the page
+    start_embeddings_preload()
+    
+    # A rerun while a response is streaming (e.g. the Stop button) cancels it, keeping what arrived
+    inflight = st.session_state.pop('_inflight', None)
+    if inflight is not None:
+        inflight['cancel'].set()
+        inflight['thread'].join(timeout=1)
+        partial = "".join(inflight['parts'])
+        if partial:
+            add_message("assistant", partial + "\n\n*(response stopped)*")
     
     # Original header
     st.markdown('<div class="main-header"><h1>LLM Code Assistant</h1><p>Advanced code analysis and general tasks</p></div>', unsafe_allow_html=True)
@@ -1157,7 +2277,7 @@ def main():
         uploaded_files = st.file_uploader(
             "Choose files (supports code, documents, PDFs, etc.)",
             accept_multiple_files=True,
-            type=list(set(ext[1:] for ext in ALL_EXTENSIONS))  # All supported extensions
+            type=UPLOADER_TYPES  # All supported extensions
         )
         
         if uploaded_files and st.button("Upload & Process"):
@@ -1195,11 +2315,9 @@ def main():
         
         # Clear Codebase
         if st.button("🗑️ Clear Codebase", type="secondary"):
-            if os.path.exists(st.session_state.codebase_handler.db_path):
-                os.remove(st.session_state.codebase_handler.db_path)
-            st.session_state.codebase_handler = EnhancedCodebaseHandler()
+            st.session_state.codebase_handler.clear_storage()
             st.session_state.messages = []
-            st.session_state.embeddings_model = None
+            st.session_state.pop('_system_message_cache', None)
             st.success("Codebase cleared!")
             st.rerun()
         
@@ -1243,29 +2361,25 @@ def main():
     st.header("Chat with your LLM")
     
     # Display chat messages
-    for message in st.session_state.messages:
+    for message_index, message in enumerate(st.session_state.messages):
         with st.chat_message(message["role"]):
-            # Handle code blocks
-            content = message["content"]
-            if "```" in content:
-                parts = content.split("```")
-                for i, part in enumerate(parts):
-                    if i % 2 == 0:
-                        if part.strip():
-                            st.markdown(part)
+            # Handle code blocks, parsed once per message
+            blocks = message_blocks(message)
+            if any(is_code for is_code, _, _ in blocks):
+                for block_index, ((is_code, language, code_content), block_key) in enumerate(
+                        zip(blocks, message_block_keys(message))):
+                    if not is_code:
+                        if code_content.strip():
+                            st.markdown(code_content)
                     else:
-                        # This is a code block
-                        lines = part.split('\n')
-                        language = lines[0].strip() if lines else ''
-                        code_content = '\n'.join(lines[1:]) if len(lines) > 1 else part
-                        
                         # Display language and run button
                         if language in SUPPORTED_LANGUAGES:
                             col1, col2 = st.columns([3, 1])
                             with col1:
                                 st.code(code_content, language=language)
                             with col2:
-                                if st.button(f"▶️ Run", key=f"run_{hash(code_content)}"):
+                                # Message and block indices keep keys unique when the same code appears twice
+                                if st.button(f"▶️ Run", key=f"run_{message_index}_{block_index}_{block_key}"):
                                     result = run_code(code_content, language)
                                     if "error" in result:
                                         st.error(result["error"])
@@ -1279,7 +2393,7 @@ def main():
                         else:
                             st.code(code_content, language=language if language else None)
             else:
-                st.markdown(content)
+                st.markdown(message["content"])
     
     # Chat input
     if prompt := st.chat_input("Ask about your codebase or request code assistance..."):
@@ -1288,7 +2402,7 @@ def main():
             st.stop()
         
         # Add user message
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        add_message("user", prompt)
         
         # Display user message
         with st.chat_message("user"):
@@ -1298,44 +2412,43 @@ def main():
         with st.chat_message("assistant"):
             with st.spinner("Analyzing..."):
                 try:
-                    # Create intelligent context (with reduced size)
-                    context = create_intelligent_context(
+                    # Create intelligent context (with reduced size), reused for repeated questions
+                    system_message = build_system_message(
                         prompt, 
                         st.session_state.codebase_handler, 
                         min(8000, st.session_state.max_context_tokens // 3)  # Reduced context size
                     )
                     
                     # Prepare messages
-                    system_prompt = get_system_prompt()
-                    if context:
-                        system_prompt += f"\n\n**Current Codebase Context:**\n{context}"
-                    
-                    api_messages = [{"role": "system", "content": system_prompt}]
+                    api_messages = [system_message]
                     api_messages.extend(st.session_state.messages[-6:])  # Only last 6 messages
                     
                     # Estimate tokens
-                    total_tokens = sum(estimate_tokens(msg['content']) for msg in api_messages)
+                    total_tokens = sum(message_tokens(msg) for msg in api_messages)
                     st.caption(f"Estimated tokens: {total_tokens}/{st.session_state.max_context_tokens}")
                     
-                    # Call API
-                    response = call_llm_api(
+                    # Call API on a background thread, rendering the response as it streams in
+                    inflight = start_llm_stream(
                         api_messages,
                         st.session_state.api_key,
                         st.session_state.model,
                         st.session_state.temperature,
                         st.session_state.max_tokens
                     )
+                    st.session_state['_inflight'] = inflight
+                    st.button("⏹️ Stop", key="stop_response")
+                    response = st.write_stream(drain_llm_stream(inflight))
+                    st.session_state.pop('_inflight', None)
                     
                     if response:
-                        # Display response
-                        st.session_state.messages.append({"role": "assistant", "content": response})
-                        st.markdown(response)
+                        add_message("assistant", response)
                     else:
                         st.error("Failed to get response from the API. Please check your API key and network connection.")
-                        st.session_state.messages.append({"role": "assistant", "content": "I'm having trouble connecting to the API. Please check your settings."})
+                        add_message("assistant", "I'm having trouble connecting to the API. Please check your settings.")
                 except Exception as e:
+                    st.session_state.pop('_inflight', None)
                     st.error(f"Error generating response: {str(e)}")
-                    st.session_state.messages.append({"role": "assistant", "content": "An error occurred while processing your request."})
+                    add_message("assistant", "An error occurred while processing your request.")
 
 if __name__ == "__main__":
     main()
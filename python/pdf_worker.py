@@ -0,0 +1,15 @@
+"""PDF page extraction for the app's worker processes.
+
+Kept out of app.py so spawned workers can import it without running the Streamlit script.
+"""
+import PyPDF2
+
+
+def extract_pdf_pages(file_path: str, start_page: int, end_page: int) -> str:
+    """Extract text from a range of PDF pages (runs in a worker process)."""
+    text = []
+    with open(file_path, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        for page_number in range(start_page, min(end_page, len(pdf_reader.pages))):
+            text.append(pdf_reader.pages[page_number].extract_text() + "\n")
+    return "".join(text)